@@ -5,22 +5,174 @@
 https://github.com/dceoy/shoper
 """
 
+import codecs
+import contextlib
 import logging
 import os
+import re
+import selectors
+import shlex
 import shutil
+import signal
 import subprocess  # noqa: S404
 import sys
-import time
-from dataclasses import dataclass
+from collections.abc import Mapping
+from dataclasses import dataclass, replace
 from pathlib import Path
-from pprint import pformat
 from typing import Any, Callable, Optional, Union
 
 logger = logging.getLogger(__name__)
 
+_RESOLVED_EXECUTABLES: dict[tuple[str, Optional[str]], str] = {}
+_SHELL_METACHARACTERS = frozenset("|&;<>()$`\\\"'*?[]{}#~=%!\n")
+_SHELL_RESERVED_WORDS = frozenset({
+    "!",
+    "[[",
+    "]]",
+    "{",
+    "}",
+    "case",
+    "coproc",
+    "do",
+    "done",
+    "elif",
+    "else",
+    "esac",
+    "fi",
+    "for",
+    "function",
+    "if",
+    "in",
+    "select",
+    "then",
+    "time",
+    "until",
+    "while",
+})
+_SHELL_BUILTINS = frozenset({
+    ".",
+    ":",
+    "[",
+    "alias",
+    "bg",
+    "bind",
+    "break",
+    "builtin",
+    "caller",
+    "cd",
+    "command",
+    "compgen",
+    "complete",
+    "compopt",
+    "continue",
+    "declare",
+    "dirs",
+    "disown",
+    "echo",
+    "enable",
+    "eval",
+    "exec",
+    "exit",
+    "export",
+    "false",
+    "fc",
+    "fg",
+    "getopts",
+    "hash",
+    "help",
+    "history",
+    "jobs",
+    "kill",
+    "let",
+    "local",
+    "logout",
+    "mapfile",
+    "popd",
+    "printf",
+    "pushd",
+    "pwd",
+    "read",
+    "readarray",
+    "readonly",
+    "return",
+    "set",
+    "shift",
+    "shopt",
+    "source",
+    "suspend",
+    "test",
+    "times",
+    "trap",
+    "true",
+    "type",
+    "typeset",
+    "ulimit",
+    "umask",
+    "unalias",
+    "unset",
+    "wait",
+})
+_ARGS2LIST_BY_TYPE: dict[type[Any], Callable[[Any], list[Any]]] = {
+    type(None): lambda _: [],
+    list: lambda a: a,
+    str: lambda a: [a],
+    type(Path()): lambda a: [a],
+}
+_DATACLASS_OPTIONS: dict[str, Any] = (
+    {"slots": True} if sys.version_info >= (3, 10) else {}
+)
 
-@dataclass
-class ShellOperator:
+
+def _which(cmd: str, path: Optional[str] = None) -> Optional[str]:
+    """Locate a command like shutil.which() with a cache shared by instances.
+
+    Like the hash table of bash, a cached path is reused while it remains
+    executable.
+
+    Args:
+        cmd: Command name.
+        path: Search path. os.environ["PATH"] is used if None.
+
+    Returns:
+        str: Path to the command, or None if it is not found.
+    """
+    key = (cmd, path)
+    resolved = _RESOLVED_EXECUTABLES.get(key)
+    if resolved and os.access(resolved, os.X_OK):
+        return resolved
+    resolved = shutil.which(cmd, path=path)
+    if resolved:
+        _RESOLVED_EXECUTABLES[key] = resolved
+    else:
+        _RESOLVED_EXECUTABLES.pop(key, None)
+    return resolved
+
+
+class _ShellOperatorState:
+    """Slots for the internal state of ShellOperator.
+
+    The state is kept out of the dataclass fields, so that dataclasses.fields()
+    and dataclasses.asdict() see the options alone, and the slotted dataclass
+    still has no instance dictionary.
+    """
+
+    __slots__ = (
+        "_ShellOperator__devnull_fd",
+        "_ShellOperator__drain_procs",
+        "_ShellOperator__executable",
+        "_ShellOperator__log_empty",
+        "_ShellOperator__log_fd",
+        "_ShellOperator__log_txt",
+        "_ShellOperator__open_proc_list",
+        "_ShellOperator__sentinel",
+        "_ShellOperator__session",
+        "_ShellOperator__session_count",
+        "_ShellOperator__session_env",
+    )
+
+
+@dataclass(**_DATACLASS_OPTIONS)
+class ShellOperator(_ShellOperatorState):
     """Simple shell operator."""
 
     log_txt: Optional[Union[str, Path]] = None
@@ -29,6 +181,9 @@ class ShellOperator:
     logger: logging.Logger = logger
     print_command: bool = True
     executable: str = "/bin/bash"
+    buffer_stdout: bool = False
+    persistent: bool = False
+    fuse: bool = False
 
     def __post_init__(self) -> None:
         """Initialize."""
@@ -36,22 +191,91 @@ class ShellOperator:
             Path(self.log_txt) if isinstance(self.log_txt, str) else self.log_txt
         )
         self.__open_proc_list: list[dict[str, Any]] = []
+        self.__executable: str = _which(self.executable) or self.executable
+        self.__log_fd: Optional[int] = None
+        self.__log_empty: bool = True
+        self.__devnull_fd: Optional[int] = None
+        self.__drain_procs: list[subprocess.Popen[bytes]] = []
+        self.__session: Optional[subprocess.Popen[bytes]] = None
+        self.__sentinel: str = f"__SHOPER_{os.urandom(8).hex()}_"
+        self.__session_count: int = 0
+        self.__session_env: dict[str, str] = {}
         if self.clear_log_txt and self.__log_txt:
             self._remove_files_or_dirs(self.__log_txt)
 
+    def __del__(self) -> None:
+        """Close the log file and the persistent shell."""
+        # the attributes are missing if __init__ failed before __post_init__
+        if hasattr(self, "_ShellOperator__session"):
+            self.close()
+
+    def __copy__(self) -> "ShellOperator":
+        """Copy the options without the descriptors and processes of the instance.
+
+        The internal state is initialized again instead of being shared, so that
+        closing either operator does not close the log file of the other one.
+
+        Returns:
+            ShellOperator: Shell operator with the same options.
+        """
+        other = replace(self, clear_log_txt=False)
+        other.clear_log_txt = self.clear_log_txt
+        return other
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> "ShellOperator":
+        """Copy the options without the descriptors and processes of the instance.
+
+        Args:
+            memo: Objects already copied.
+
+        Returns:
+            ShellOperator: Shell operator with the same options.
+        """
+        memo[id(self)] = other = self.__copy__()
+        return other
+
+    def close(self) -> None:
+        """Close the log file and the persistent shell."""
+        for fd in (self.__log_fd, self.__devnull_fd):
+            if fd is not None:
+                os.close(fd)
+        self.__log_fd = None
+        self.__devnull_fd = None
+        for p in self.__drain_procs:
+            p.wait()
+        self.__drain_procs = []
+        self._close_session()
+
     def _remove_files_or_dirs(self, paths: Any) -> None:
         """Remove files or directories.
 
         Args:
             paths: Files or directories.
         """
-        for p in self._args2pathlist(paths):
-            if p.is_dir():
-                shutil.rmtree(str(p))
-                self.logger.warning("directory removed: %s", p)
-            elif p.exists():
-                Path(str(p)).unlink()
-                self.logger.warning("file removed: %s", p)
+        for p in dict.fromkeys(self._args2pathlist(paths)):
+            self._remove_file_or_dir(p)
+
+    def _remove_file_or_dir(self, path: Path) -> None:
+        """Remove a file or directory if it exists.
+
+        Args:
+            path: File or directory.
+
+        Raises:
+            IsADirectoryError: If the path cannot be unlinked and is not a directory.
+            PermissionError: If the path cannot be unlinked and is not a directory.
+        """
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return
+        except (IsADirectoryError, PermissionError):
+            if not path.is_dir():
+                raise
+            shutil.rmtree(path)
+            self.logger.warning("directory removed: %s", path)
+        else:
+            self.logger.warning("file removed: %s", path)
 
     def run(
         self,
@@ -86,26 +310,25 @@ class ShellOperator:
             FileNotFoundError: If input files or directories are not found.
             subprocess.SubprocessError: If commands return non-zero exit statuses.
         """
-        self.logger.debug("input_files_or_dirs: %s", input_files_or_dirs)
-        input_found = {
-            str(p): p.exists() for p in self._args2pathlist(input_files_or_dirs)
-        }
-        self.logger.debug("input_found: %s", input_found)
-        self.logger.debug("output_files_or_dirs: %s", output_files_or_dirs)
-        output_found = {
-            str(p): p.exists() for p in self._args2pathlist(output_files_or_dirs)
-        }
-        self.logger.debug("output_found: %s", output_found)
-        if input_files_or_dirs and not all(input_found.values()):
-            raise FileNotFoundError(
-                "input not found: "
-                + ", ".join([p for p, b in input_found.items() if not b])
+        input_paths = self._args2pathlist(input_files_or_dirs)
+        output_paths = self._args2pathlist(output_files_or_dirs)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("input_files_or_dirs: %s", input_files_or_dirs)
+            self.logger.debug(
+                "input_found: %s", {str(p): p.exists() for p in input_paths}
             )
-        elif output_files_or_dirs and all(output_found.values()) and skip_if_exist:
+            self.logger.debug("output_files_or_dirs: %s", output_files_or_dirs)
+            self.logger.debug(
+                "output_found: %s", {str(p): p.exists() for p in output_paths}
+            )
+        input_missing = [str(p) for p in input_paths if not p.exists()]
+        if input_missing:
+            raise FileNotFoundError("input not found: " + ", ".join(input_missing))
+        elif output_paths and skip_if_exist and all(p.exists() for p in output_paths):
             self.logger.debug("args skipped: %s", args)
         else:
             if remove_previous:
-                self._remove_files_or_dirs(output_files_or_dirs)
+                self._remove_files_or_dirs(output_paths)
             common_kwargs = {
                 "prompt": (prompt or f"[{cwd or Path.cwd()}] $ "),
                 "cwd": (str(cwd) if cwd else None),
@@ -113,48 +336,169 @@ class ShellOperator:
             }
             if asynchronous:
                 self.__open_proc_list.append({
-                    "output_files_or_dirs": output_files_or_dirs,
+                    "output_files_or_dirs": output_paths,
                     "output_validator": output_validator,
                     "remove_if_failed": remove_if_failed,
                     "procs": [
-                        self._popen(arg=a, **common_kwargs)
+                        self._spawn(stages=[a], background=True, **common_kwargs)[0]
                         for a in self._args2list(args)
                     ],
                 })
             else:
+                arg_list = self._args2list(args)
+                if self.fuse and len(arg_list) > 1:
+                    # run in a single shell, printed as the original commands
+                    common_kwargs["command_line"] = " && ".join(map(str, arg_list))
+                    arg_list = [" && ".join(f"{{ {a}{os.linesep}}}" for a in arg_list)]
                 try:
-                    procs = [
-                        self._shell_c(arg=a, **common_kwargs)
-                        for a in self._args2list(args)
-                    ]
+                    if self.persistent and not popen_kwargs:
+                        procs: list[Any] = [
+                            self._shell_s(arg=a, **common_kwargs) for a in arg_list
+                        ]
+                    else:
+                        procs = [
+                            self._spawn(stages=[a], **common_kwargs)[0]
+                            for a in arg_list
+                        ]
                 except subprocess.SubprocessError:
-                    if output_files_or_dirs and remove_if_failed:
-                        self._remove_files_or_dirs(output_files_or_dirs)
+                    if output_paths and remove_if_failed:
+                        self._remove_files_or_dirs(output_paths)
                     raise
                 self._validate_results(
                     procs=procs,
-                    output_files_or_dirs=output_files_or_dirs,
+                    output_files_or_dirs=output_paths,
                     output_validator=output_validator,
                     remove_if_failed=remove_if_failed,
                 )
 
     def wait(self) -> None:
-        """Wait for all processes to finish."""
+        """Wait for all processes to finish.
+
+        Processes started by each call of run() are validated as soon as all of
+        them have finished, regardless of the order of the calls.
+        """
         if self.__open_proc_list:
-            for d in self.__open_proc_list:
-                for p in d["procs"]:
-                    p.wait()
-                    [f.close() for f in [p.stdout, p.stderr] if f]
-                self._validate_results(
-                    procs=d["procs"],
-                    output_files_or_dirs=d["output_files_or_dirs"],
-                    output_validator=d["output_validator"],
-                    remove_if_failed=d["remove_if_failed"],
-                )
-            self.__open_proc_list = []
+            with selectors.DefaultSelector() as sel:
+                try:
+                    self._register_pidfds(sel)
+                    while self._validate_finished_procs():
+                        self._wait_for_any_proc(sel)
+                finally:
+                    for k in list(sel.get_map().values()):
+                        sel.unregister(k.fd)
+                        os.close(k.fd)
         else:
             self.logger.debug("There is no process.")
 
+    def pipeline(
+        self,
+        stages: list[str],
+        cwd: Optional[Union[str, Path]] = None,
+        prompt: Optional[str] = None,
+        **popen_kwargs: Any,
+    ) -> None:
+        """Run shell commands connected with pipes.
+
+        The standard output of each command is passed to the standard input of
+        the next one, and all the commands run concurrently. A command killed by
+        SIGPIPE, or run by a shell reporting such a death as the exit status 141,
+        is not regarded as failed unless it is the last one. Any other failure
+        raises subprocess.SubprocessError as in run().
+
+        Args:
+            stages: Command line arguments.
+            cwd: Current working directory.
+            prompt: Prompt string.
+            popen_kwargs: Keyword arguments for subprocess.Popen.
+
+        Raises:
+            ValueError: If stages is empty.
+        """
+        stage_list = self._args2list(stages)
+        if not stage_list:
+            error_message = "stages is empty"
+            raise ValueError(error_message)
+        procs = self._spawn(
+            stages=stage_list,
+            prompt=(prompt or f"[{cwd or Path.cwd()}] $ "),
+            cwd=(str(cwd) if cwd else None),
+            **popen_kwargs,
+        )
+        self._validate_results(
+            procs=[
+                p
+                for p in procs[:-1]
+                if p.returncode not in {-signal.SIGPIPE, 128 + signal.SIGPIPE}
+            ]
+            + procs[-1:]
+        )
+
+    def _register_pidfds(self, sel: selectors.BaseSelector) -> None:
+        """Register pidfds of the asynchronous processes with a selector.
+
+        Args:
+            sel: Selector.
+        """
+        for d in self.__open_proc_list:
+            for p in d["procs"]:
+                pidfd = self._open_pidfd(p)
+                if pidfd is not None:
+                    sel.register(pidfd, selectors.EVENT_READ, p)
+
+    def _wait_for_any_proc(self, sel: selectors.BaseSelector) -> None:
+        """Wait for any of the asynchronous processes to finish.
+
+        Without pidfds, wait for the first unfinished process instead.
+
+        Args:
+            sel: Selector with the pidfds of the processes.
+        """
+        if sel.get_map():
+            for k, _ in sel.select():
+                sel.unregister(k.fd)
+                os.close(k.fd)
+                k.data.wait()
+        else:
+            next(
+                p
+                for d in self.__open_proc_list
+                for p in d["procs"]
+                if p.returncode is None
+            ).wait()
+
+    def _validate_finished_procs(self) -> bool:
+        """Validate results of asynchronous runs whose processes have finished.
+
+        Returns:
+            bool: True if any asynchronous run is still in progress.
+        """
+        for d in [
+            d
+            for d in self.__open_proc_list
+            if all(p.returncode is not None for p in d["procs"])
+        ]:
+            self.__open_proc_list.remove(d)
+            for p in d["procs"]:
+                self._close_streams(p)
+            self._validate_results(
+                procs=d["procs"],
+                output_files_or_dirs=d["output_files_or_dirs"],
+                output_validator=d["output_validator"],
+                remove_if_failed=d["remove_if_failed"],
+            )
+        return bool(self.__open_proc_list)
+
+    @staticmethod
+    def _close_streams(proc: subprocess.Popen[Any]) -> None:
+        """Close the output streams of a process.
+
+        Args:
+            proc: Process.
+        """
+        for f in (proc.stdout, proc.stderr):
+            if f:
+                f.close()
+
     def _args2pathlist(self, args: Any) -> list[Path]:
         """Convert arguments to a list of Path objects.
 
@@ -164,7 +508,12 @@ class ShellOperator:
         Returns:
             list: List of Path objects.
         """
-        return [Path(str(a)) for a in self._args2list(args=args)]
+        if args is None:
+            return []
+        return [
+            a if isinstance(a, Path) else Path(str(a))
+            for a in self._args2list(args=args)
+        ]
 
     @staticmethod
     def _args2list(args: Any) -> list[Any]:
@@ -176,123 +525,499 @@ class ShellOperator:
         Returns:
             list: List of arguments.
         """
-        if isinstance(args, (str, Path)):
-            return [args]
+        args_type: type[Any] = type(args)
+        to_list = _ARGS2LIST_BY_TYPE.get(args_type)
+        if to_list:
+            return to_list(args)
         elif isinstance(args, list):
             return args
-        elif args is None:
-            return []
+        elif isinstance(args, (str, Path)):
+            return [args]
         else:
             return list(args)
 
-    def _popen(
-        self, arg: str, prompt: str, cwd: Optional[str] = None, **popen_kwargs: Any
-    ) -> subprocess.Popen[Any]:
-        """Run a command asynchronously.
+    def _spawn(
+        self,
+        stages: list[str],
+        prompt: str,
+        cwd: Optional[str] = None,
+        background: bool = False,
+        command_line: Optional[str] = None,
+        **popen_kwargs: Any,
+    ) -> list[subprocess.Popen[Any]]:
+        """Run commands connected with pipes.
 
         Args:
-            arg: Command line argument.
+            stages: Command line arguments.
             prompt: Prompt string.
             cwd: Current working directory.
-            popen_kwargs: Keyword arguments for subprocess.Popen:open.
+            background: Return without waiting for the processes to finish.
+            command_line: Command line printed instead of the stages.
+            popen_kwargs: Keyword arguments for subprocess.Popen.
+
+        Returns:
+            list: Processes.
+        """
+        # reap the processes which have copied late output into the log file
+        self.__drain_procs = [p for p in self.__drain_procs if p.poll() is None]
+        command_line = prompt + (command_line or " | ".join(stages))
+        self._print_line(
+            command_line,
+            stdout=self.print_command,
+            flush=(
+                not self.buffer_stdout
+                or not (self.__log_txt or self.quiet or background)
+            ),
+        )
+        fw, fd_r, fd_w = self._open_output(
+            command_line=command_line, background=background
+        )
+        try:
+            procs = self._popen_stages(
+                stages=stages,
+                stdout=(fw if fd_w is None else fd_w),
+                cwd=cwd,
+                **popen_kwargs,
+            )
+            if fw is not None and fd_r is not None and fd_w is not None:
+                os.close(fd_w)
+                fd_w = None
+                drain = self._tee_output(
+                    proc=procs[-1], fd=fd_r, log_fd=fw, flush=(not self.buffer_stdout)
+                )
+                if drain:
+                    self.__drain_procs.append(drain)
+            if not background:
+                for p in procs:
+                    p.wait()
+        finally:
+            for fd in (fd_r, fd_w):
+                if fd is not None:
+                    os.close(fd)
+        return procs
+
+    def _open_output(
+        self, command_line: str, background: bool = False
+    ) -> tuple[Optional[int], Optional[int], Optional[int]]:
+        """Open file descriptors for the output of commands.
+
+        Args:
+            command_line: Command line written into the log file.
+            background: Discard the output unless it is logged.
 
         Returns:
-            subprocess.Popen: Process.
+            tuple: File descriptor of the log file or /dev/null, or None for stdout,
+                and both ends of a pipe to tee the output into the log file and
+                stdout, or None.
         """
-        self.logger.debug("%s <- `%s`", self.executable, arg)
-        command_line = prompt + arg
-        self._print_line(command_line, stdout=self.print_command)
         if self.__log_txt:
-            if Path(self.__log_txt).exists():
-                with Path(self.__log_txt).open(mode="a", encoding="utf-8") as f:
-                    f.write(os.linesep + command_line + os.linesep)
+            fw = self._log_command_line(command_line)
+            if self.quiet or background:
+                return fw, None, None
             else:
-                with Path(self.__log_txt).open(mode="w", encoding="utf-8") as f:
-                    f.write(command_line + os.linesep)
-            fo = Path(self.__log_txt).open(mode="a", encoding="utf-8")  # noqa: SIM115
+                fd_r, fd_w = os.pipe()
+                return fw, fd_r, fd_w
+        elif self.quiet or background:
+            return self._get_devnull(), None, None
         else:
-            fo = Path("/dev/null").open(mode="w", encoding="utf-8")     # noqa: SIM115
-        return subprocess.Popen(
-            args=arg,
-            executable=self.executable,
-            stdout=fo,
-            stderr=fo,
-            shell=True,
-            cwd=cwd,
-            **popen_kwargs,
-        )
+            return None, None, None
 
-    def _shell_c(
-        self, arg: str, prompt: str, cwd: Optional[str] = None, **popen_kwargs: Any
-    ) -> subprocess.Popen[Any]:
-        """Run a command synchronously.
+    def _popen_stages(
+        self,
+        stages: list[str],
+        stdout: Optional[int] = None,
+        cwd: Optional[str] = None,
+        **popen_kwargs: Any,
+    ) -> list[subprocess.Popen[Any]]:
+        """Start commands connected with pipes.
+
+        Args:
+            stages: Command line arguments.
+            stdout: File descriptor for stdout of the last command and stderr of
+                all the commands.
+            cwd: Current working directory.
+            popen_kwargs: Keyword arguments for subprocess.Popen.
+
+        Returns:
+            list: Processes.
+        """
+        stdin = popen_kwargs.pop("stdin", None)
+        pipe_r: Optional[int] = None
+        procs: list[subprocess.Popen[Any]] = []
+        try:
+            for i, a in enumerate(stages):
+                next_r, pipe_w = os.pipe() if i < len(stages) - 1 else (None, None)
+                try:
+                    p = subprocess.Popen(
+                        **self._arg2popen_kwargs(arg=a, env=popen_kwargs.get("env")),
+                        stdin=(stdin if pipe_r is None else pipe_r),
+                        stdout=(stdout if pipe_w is None else pipe_w),
+                        stderr=stdout,
+                        cwd=cwd,
+                        **popen_kwargs,
+                    )
+                    procs.append(p)
+                finally:
+                    for fd in (pipe_r, pipe_w):
+                        if fd is not None:
+                            os.close(fd)
+                    pipe_r = next_r
+        finally:
+            if pipe_r is not None:
+                os.close(pipe_r)
+        return procs
+
+    def _shell_s(
+        self,
+        arg: str,
+        prompt: str,
+        cwd: Optional[str] = None,
+        command_line: Optional[str] = None,
+    ) -> subprocess.CompletedProcess[bytes]:
+        """Run a command synchronously in the persistent shell.
+
+        The command is passed as a quoted string to eval in a subshell with stdin
+        redirected from /dev/null, so that a syntax error such as an unterminated
+        quote fails the command alone instead of consuming the rest of the script.
+        Its exit status is read from a sentinel line numbered for each command.
+        The shell is killed if the command is interrupted before the sentinel is
+        read, so that its remaining output is not taken for that of the next one.
+        The command runs in cwd, or in the current working directory of Python if
+        cwd is None.
 
         Args:
             arg: Command line argument.
             prompt: Prompt string.
             cwd: Current working directory.
-            popen_kwargs: Keyword arguments for subprocess.Popen.
+            command_line: Command line printed instead of arg.
 
         Returns:
-            subprocess.Popen: Process.
+            subprocess.CompletedProcess: Completed process.
+
+        Raises:
+            subprocess.SubprocessError: If the persistent shell exits.
         """
-        self.logger.debug("%s <- `%s`", self.executable, arg)
-        command_line = prompt + arg
-        self._print_line(command_line, stdout=self.print_command)
-        if self.__log_txt:
-            if Path(self.__log_txt).exists():
-                with Path(self.__log_txt).open(mode="a", encoding="utf-8") as f:
-                    f.write(os.linesep + command_line + os.linesep)
-            else:
-                with Path(self.__log_txt).open(mode="w", encoding="utf-8") as f:
-                    f.write(command_line + os.linesep)
-            fw = Path(self.__log_txt).open(mode="a", encoding="utf-8")  # noqa: SIM115
-        elif self.quiet:
-            fw = Path("/dev/null").open(mode="w", encoding="utf-8")     # noqa: SIM115
-        else:
-            fw = None
-        if self.__log_txt and not self.quiet:
-            fr = Path(self.__log_txt).open(mode="r", encoding="utf-8")  # noqa: SIM115
-            fr.read()
-        else:
-            fr = None
-        p = subprocess.Popen(
-            args=arg,
-            executable=self.executable,
-            stdout=fw,
-            stderr=fw,
-            shell=True,
-            cwd=cwd,
-            **popen_kwargs,
+        command_line = prompt + (command_line or arg)
+        self._print_line(
+            command_line, stdout=self.print_command, flush=(not self.buffer_stdout)
+        )
+        log_fd = self._log_command_line(command_line) if self.__log_txt else None
+        write_stdout = None if self.quiet else self._stdout_writer()
+        session = self._get_session()
+        self.__session_count += 1
+        sentinel = f"{self.__sentinel}{self.__session_count}_"
+        script = (
+            f"( cd -- {shlex.quote(cwd or str(Path.cwd()))}"
+            f" && eval {shlex.quote(arg)} ) < /dev/null{os.linesep}"
+            f"printf '{sentinel}%d__\\n' $?{os.linesep}"
         )
-        if fr:
-            while p.poll() is None:
-                sys.stdout.write(fr.read())
+        if not (session.stdin and session.stdout):
+            error_message = "persistent shell has no pipes"
+            raise subprocess.SubprocessError(error_message)
+        returncode: Optional[int] = None
+        try:
+            session.stdin.write(script.encode("utf-8"))
+            session.stdin.flush()
+            returncode = self._read_session_output(
+                fd=session.stdout.fileno(),
+                sentinel=sentinel,
+                log_fd=log_fd,
+                write_stdout=write_stdout,
+            )
+            if returncode is None:
+                session.wait()
+                error_message = f"persistent shell exited with {session.returncode}"
+                raise subprocess.SubprocessError(error_message)
+        finally:
+            if returncode is None:
+                # the output of an interrupted command would be read by the next
+                self._close_session(kill=True)
+            if write_stdout:
                 sys.stdout.flush()
-                time.sleep(0.1)
-            sys.stdout.write(fr.read())
-            sys.stdout.flush()
-            fr.close()
-        else:
-            p.wait()
-        if fw:
-            fw.close()
-        return p
+        return subprocess.CompletedProcess(args=arg, returncode=returncode)
+
+    def _get_session(self) -> subprocess.Popen[bytes]:
+        """Get the persistent shell, starting it if needed.
+
+        The shell keeps the environment variables it was started with, so it is
+        restarted if os.environ has changed since then.
+
+        As in the other modes, stderr of the commands is written into the log file
+        with stdout if any, and otherwise goes to stderr unless quiet is set.
+
+        Returns:
+            subprocess.Popen: Persistent shell.
+        """
+        env = dict(os.environ)
+        if self.__session is not None and (
+            self.__session.poll() is not None or self.__session_env != env
+        ):
+            self._close_session()
+        if self.__session is None:
+            self.__session = subprocess.Popen(  # noqa: S603
+                args=[self.__executable, "-s"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=(
+                    subprocess.STDOUT
+                    if self.__log_txt
+                    else (self._get_devnull() if self.quiet else None)
+                ),
+            )
+            self.__session_env = env
+        return self.__session
+
+    def _read_session_output(
+        self,
+        fd: int,
+        sentinel: str,
+        log_fd: Optional[int] = None,
+        write_stdout: Optional[Callable[[bytes], Any]] = None,
+    ) -> Optional[int]:
+        """Copy the output of the persistent shell until a sentinel line.
+
+        Args:
+            fd: Read end of the pipe from the persistent shell.
+            sentinel: Sentinel printed before the exit status of the command.
+            log_fd: File descriptor of the log file.
+            write_stdout: Function writing bytes to stdout.
+
+        Returns:
+            int: Exit status of the command, or None if the shell has exited.
+        """
+        pattern = re.compile(re.escape(sentinel).encode() + rb"(\d+)__\n")
+        buf = b""
+        while True:
+            data = os.read(fd, 65536)
+            buf += data
+            m = pattern.search(buf) if data else None
+            if m:
+                end = m.start()
+            elif data:
+                # hold back the bytes which can be the beginning of the sentinel
+                end = max(len(buf) - len(sentinel) - 8, 0)
+            else:
+                end = len(buf)
+            if end:
+                if log_fd is not None:
+                    os.write(log_fd, buf[:end])
+                if write_stdout:
+                    write_stdout(buf[:end])
+                    if not self.buffer_stdout:
+                        sys.stdout.flush()
+                buf = buf[end:]
+            if m:
+                return int(m.group(1))
+            elif not data:
+                return None
+
+    def _close_session(self, kill: bool = False) -> None:
+        """Close the persistent shell.
+
+        Args:
+            kill: Kill the shell instead of waiting for it to exit.
+        """
+        session = self.__session
+        if session is not None:
+            self.__session = None
+            if kill:
+                session.kill()
+            if session.stdin:
+                with contextlib.suppress(BrokenPipeError):
+                    session.stdin.close()
+            session.wait()
+            if session.stdout:
+                session.stdout.close()
+
+    def _get_devnull(self) -> int:
+        """Get a file descriptor of /dev/null shared by processes.
+
+        Returns:
+            int: File descriptor of /dev/null opened for writing.
+        """
+        if self.__devnull_fd is None:
+            self.__devnull_fd = os.open(os.devnull, os.O_WRONLY)
+        return self.__devnull_fd
+
+    def _log_command_line(self, command_line: str) -> int:
+        """Write a command line into the log file.
+
+        Args:
+            command_line: Command line.
+
+        Returns:
+            int: File descriptor of the log file opened in append mode.
+        """
+        if self.__log_fd is None:
+            self.__log_fd = os.open(
+                str(self.__log_txt), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666
+            )
+            self.__log_empty = os.fstat(self.__log_fd).st_size == 0
+        prefix = "" if self.__log_empty else os.linesep
+        os.write(self.__log_fd, (prefix + command_line + os.linesep).encode("utf-8"))
+        self.__log_empty = False
+        return self.__log_fd
+
+    def _arg2popen_kwargs(
+        self, arg: str, env: Optional[Mapping[str, str]] = None
+    ) -> dict[str, Any]:
+        """Convert a command line to keyword arguments for subprocess.Popen.
+
+        A simple command without any shell syntax is executed directly to skip
+        the startup of the shell, unless it is a shell builtin, which can behave
+        differently from the executable of the same name, or the shell is not
+        bash or sh.
+
+        Args:
+            arg: Command line argument.
+            env: Environment variables for the command.
 
-    def _print_line(self, strings: str, stdout: bool = True) -> None:
+        Returns:
+            dict: Keyword arguments for subprocess.Popen.
+        """
+        shell_name = Path(self.__executable).name
+        if shell_name in {"bash", "sh"} and _SHELL_METACHARACTERS.isdisjoint(arg):
+            argv = shlex.split(arg)
+            if (
+                argv
+                and "/" not in argv[0]
+                and argv[0] not in _SHELL_RESERVED_WORDS
+                and argv[0] not in _SHELL_BUILTINS
+            ):
+                executable = _which(
+                    argv[0], path=(os.environ if env is None else env).get("PATH")
+                )
+                if executable:
+                    self.logger.debug("%s <- %s", executable, argv)
+                    return {"args": argv, "executable": executable, "shell": False}
+        self.logger.debug("%s <- `%s`", self.__executable, arg)
+        return {"args": [self.__executable, "-c", arg], "shell": False}
+
+    @staticmethod
+    def _open_pidfd(proc: subprocess.Popen[Any]) -> Optional[int]:
+        """Open a file descriptor referring to a running process.
+
+        Args:
+            proc: Process.
+
+        Returns:
+            int: File descriptor readable after the process exits, or None if
+                the process has finished or pidfd_open(2) is not available.
+        """
+        if proc.returncode is not None or not hasattr(os, "pidfd_open"):
+            return None
+        try:
+            return os.pidfd_open(proc.pid)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _tee_output(
+        proc: subprocess.Popen[Any], fd: int, log_fd: int, flush: bool = True
+    ) -> Optional[subprocess.Popen[bytes]]:
+        """Copy the output of a process from a pipe to a log file and stdout.
+
+        Output written after the process exits by its background descendants is
+        only copied to the log file.
+
+        Args:
+            proc: Process writing to the pipe.
+            fd: Read end of the pipe.
+            log_fd: File descriptor of the log file.
+            flush: Flush stdout after each read instead of at the end.
+
+        Returns:
+            subprocess.Popen: Process copying the late output to the log file, or
+                None if the pipe has been closed.
+        """
+        write_stdout = ShellOperator._stdout_writer()
+        pidfd = ShellOperator._open_pidfd(proc)
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            if pidfd is not None:
+                sel.register(pidfd, selectors.EVENT_READ)
+            try:
+                while True:
+                    ready = {
+                        k.fd for k, _ in sel.select(None if pidfd is not None else 0.1)
+                    }
+                    if fd in ready:
+                        data = os.read(fd, 65536)
+                    elif proc.poll() is not None:
+                        # the pipe can be kept open by a background descendant
+                        os.set_blocking(fd, False)
+                        try:
+                            data = os.read(fd, 65536)
+                        except BlockingIOError:
+                            return ShellOperator._drain_to_log(fd=fd, log_fd=log_fd)
+                    else:
+                        continue
+                    if not data:
+                        break
+                    os.write(log_fd, data)
+                    write_stdout(data)
+                    if flush:
+                        sys.stdout.flush()
+            finally:
+                if pidfd is not None:
+                    os.close(pidfd)
+                sys.stdout.flush()
+        return None
+
+    @staticmethod
+    def _drain_to_log(fd: int, log_fd: int) -> Optional[subprocess.Popen[bytes]]:
+        """Hand over a pipe still open for writing to a process copying it to a log.
+
+        Background descendants of a finished command can keep writing to the pipe.
+        A cat process reads it until they close it, so that their output is kept
+        in the log file and they are not killed by SIGPIPE.
+
+        Args:
+            fd: Read end of the pipe.
+            log_fd: File descriptor of the log file.
+
+        Returns:
+            subprocess.Popen: Process copying the pipe, or None if cat is not found.
+        """
+        cat = _which("cat")
+        if not cat:
+            return None
+        os.set_blocking(fd, True)
+        return subprocess.Popen(args=[cat], stdin=fd, stdout=log_fd)  # noqa: S603
+
+    @staticmethod
+    def _stdout_writer() -> Callable[[bytes], Any]:
+        """Create a function writing bytes to stdout.
+
+        Returns:
+            Callable: Function writing bytes to stdout.
+        """
+        sys.stdout.flush()
+        stdout_buffer = getattr(sys.stdout, "buffer", None)
+        if stdout_buffer:
+            return stdout_buffer.write
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        return lambda b: sys.stdout.write(decoder.decode(b))
+
+    def _print_line(
+        self, strings: str, stdout: bool = True, flush: bool = True
+    ) -> None:
         """Print a line.
 
         Args:
             strings: Strings to print.
             stdout: Print to stdout.
+            flush: Flush stdout after printing.
         """
         self.logger.info(strings)
         if stdout:
-            print(strings, flush=True)  # noqa: T201
+            sys.stdout.write(strings + "\n")
+            if flush:
+                sys.stdout.flush()
 
     def _validate_results(
         self,
-        procs: list[subprocess.Popen[Any]],
+        procs: list[Any],
         output_files_or_dirs: Optional[Union[str, Path, list[Union[str, Path]]]] = None,
         output_validator: Optional[Callable[[str], bool]] = None,
         remove_if_failed: bool = True,
@@ -308,14 +1033,17 @@ class ShellOperator:
         Raises:
             subprocess.SubprocessError: If commands return non-zero exit statuses.
         """
-        p_failed = [vars(p) for p in procs if p.returncode != 0]
+        p_failed = [p for p in procs if p.returncode != 0]
         if p_failed:
             if output_files_or_dirs and remove_if_failed:
                 self._remove_files_or_dirs(output_files_or_dirs)
             raise subprocess.SubprocessError(
                 "Commands returned non-zero exit statuses:"
-                + os.linesep
-                + pformat(p_failed)
+                + "".join(
+                    f"{os.linesep}pid={getattr(p, 'pid', None)}"
+                    f" returncode={p.returncode} args={p.args!r}"
+                    for p in p_failed
+                )
             )
         elif output_files_or_dirs:
             self._validate_outputs(
@@ -0,0 +1,337 @@
+"""Tests for shoper.shelloperator."""
+
+import copy
+import logging
+import subprocess
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import pytest
+
+from shoper import ShellOperator
+
+
+@pytest.fixture
+def workdir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Change the current working directory to a temporary directory.
+
+    Args:
+        tmp_path: Temporary directory.
+        monkeypatch: Monkeypatch fixture.
+
+    Returns:
+        Path: Temporary directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def make_sh() -> Iterator[Callable[..., ShellOperator]]:
+    """Create shell operators closed after the test.
+
+    Yields:
+        Callable: Function creating a shell operator.
+    """
+    created: list[ShellOperator] = []
+
+    def make(**kwargs: Any) -> ShellOperator:
+        sh = ShellOperator(**kwargs)
+        created.append(sh)
+        return sh
+
+    yield make
+    for sh in created:
+        sh.close()
+
+
+@pytest.fixture
+def persistent_sh(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> ShellOperator:
+    """Create a shell operator in persistent mode.
+
+    Args:
+        make_sh: Function creating a shell operator.
+        workdir: Temporary working directory.
+
+    Returns:
+        ShellOperator: Shell operator logging into log.txt.
+    """
+    return make_sh(log_txt=(workdir / "log.txt"), persistent=True)
+
+
+def test_persistent_reuses_shell(persistent_sh: ShellOperator, workdir: Path) -> None:
+    """Synchronous commands run in the same shell process."""
+    persistent_sh.run("echo $$ > a.txt", output_files_or_dirs="a.txt")
+    persistent_sh.run("echo $$ > b.txt", output_files_or_dirs="b.txt")
+    assert (workdir / "a.txt").read_text() == (workdir / "b.txt").read_text()
+
+
+def test_persistent_unterminated_quote(
+    persistent_sh: ShellOperator, workdir: Path
+) -> None:
+    """A syntax error fails the command alone."""
+    with pytest.raises(subprocess.SubprocessError):
+        persistent_sh.run("echo 'unterminated")
+    persistent_sh.run("echo ok > ok.txt", output_files_or_dirs="ok.txt")
+    assert (workdir / "ok.txt").read_text() == "ok\n"
+
+
+def test_persistent_restarts_after_exit(
+    persistent_sh: ShellOperator, workdir: Path
+) -> None:
+    """The shell is restarted after it has been killed."""
+    with pytest.raises(subprocess.SubprocessError):
+        persistent_sh.run("printf partial; kill -9 $$")
+    persistent_sh.run("echo ok > ok.txt", output_files_or_dirs="ok.txt")
+    assert "partial" in (workdir / "log.txt").read_text()
+    assert (workdir / "ok.txt").read_text() == "ok\n"
+
+
+def test_persistent_follows_cwd_and_env(
+    persistent_sh: ShellOperator, workdir: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Commands see the current cwd and environment of Python."""
+    persistent_sh.run("pwd > cwd0.txt")
+    subdir = workdir / "sub"
+    subdir.mkdir()
+    persistent_sh.run("pwd > cwd1.txt", cwd=subdir)
+    monkeypatch.setenv("SHOPER_TEST_VALUE", "changed")
+    persistent_sh.run("echo ${SHOPER_TEST_VALUE} > env.txt")
+    assert Path((workdir / "cwd0.txt").read_text().strip()) == workdir.resolve()
+    assert Path((subdir / "cwd1.txt").read_text().strip()) == subdir.resolve()
+    assert (workdir / "env.txt").read_text() == "changed\n"
+
+
+def test_fuse_runs_in_one_shell(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Fused commands share a shell and are logged as the original commands."""
+    sh = make_sh(log_txt=(workdir / "log.txt"), fuse=True)
+    sh.run(["echo $$ > a.txt", "echo $$ > b.txt"])
+    assert (workdir / "a.txt").read_text() == (workdir / "b.txt").read_text()
+    log = (workdir / "log.txt").read_text()
+    assert "$ echo $$ > a.txt && echo $$ > b.txt\n" in log
+
+
+def test_fuse_stops_at_failure(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Fused commands stop at the first failure."""
+    sh = make_sh(quiet=True, fuse=True)
+    with pytest.raises(subprocess.SubprocessError):
+        sh.run(["false", "touch never.txt"])
+    assert not (workdir / "never.txt").exists()
+
+
+def test_wait_validates_in_completion_order(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Asynchronous runs are validated in the order they finish."""
+    validated: list[str] = []
+
+    def validator(path: str) -> bool:
+        validated.append(path)
+        return True
+
+    sh = make_sh(quiet=True)
+    sh.run(
+        "sleep 1 && touch slow.txt",
+        output_files_or_dirs="slow.txt",
+        output_validator=validator,
+        asynchronous=True,
+    )
+    sh.run(
+        "touch fast.txt",
+        output_files_or_dirs="fast.txt",
+        output_validator=validator,
+        asynchronous=True,
+    )
+    sh.wait()
+    assert validated == ["fast.txt", "slow.txt"]
+    assert (workdir / "slow.txt").exists()
+
+
+def test_pipeline(make_sh: Callable[..., ShellOperator], workdir: Path) -> None:
+    """Commands are connected with pipes."""
+    sh = make_sh(quiet=True)
+    sh.pipeline(stages=["printf 'b\\na\\nb\\n'", "sort", "uniq -c > out.txt"])
+    assert (workdir / "out.txt").read_text().split() == ["1", "a", "2", "b"]
+
+
+def test_pipeline_excuses_sigpipe(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Upstream commands killed by SIGPIPE are not regarded as failed."""
+    sh = make_sh(quiet=True)
+    sh.pipeline(stages=["yes", "head -1 > out.txt"])
+    sh.pipeline(stages=["yes | cat", "head -1 > out.txt"])
+    assert (workdir / "out.txt").read_text() == "y\n"
+    with pytest.raises(subprocess.SubprocessError):
+        sh.pipeline(stages=["echo a", "false"])
+
+
+def test_pipeline_rejects_empty_stages(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """An empty pipeline is rejected before anything is printed or logged."""
+    sh = make_sh(log_txt=(workdir / "log.txt"))
+    with pytest.raises(ValueError, match="stages is empty"):
+        sh.pipeline(stages=[])
+    assert not (workdir / "log.txt").exists()
+
+
+def test_simple_command_runs_directly(
+    make_sh: Callable[..., ShellOperator],
+    workdir: Path,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """A simple command is executed without a shell."""
+    sh = make_sh(quiet=True)
+    with caplog.at_level(logging.DEBUG, logger="shoper.shelloperator"):
+        sh.run("touch a.txt", output_files_or_dirs="a.txt")
+    assert any(r.getMessage().endswith("<- ['touch', 'a.txt']") for r in caplog.records)
+    assert (workdir / "a.txt").exists()
+
+
+def test_shell_builtins_run_in_shell(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Builtins keep their shell behavior instead of running the executables."""
+    sh = make_sh(log_txt=(workdir / "log.txt"), print_command=False, quiet=True)
+    sh.run("test -v HOME")
+    sh.run("echo --version")
+    assert (workdir / "log.txt").read_text().endswith("$ echo --version\n--version\n")
+
+
+def test_late_output_is_logged(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Output of a background descendant after the command exits is logged."""
+    sh = make_sh(log_txt=(workdir / "log.txt"))
+    sh.run("echo early; (sleep 0.5; echo late) &")
+    sh.close()
+    assert (workdir / "log.txt").read_text().endswith("early\nlate\n")
+
+
+def test_log_separates_command_lines(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Command lines are separated by an empty line, except at the beginning."""
+    sh = make_sh(log_txt=(workdir / "log.txt"), quiet=True)
+    sh.run("echo a", prompt="$ ")
+    sh.run("echo b", prompt="$ ")
+    sh.close()
+    assert (workdir / "log.txt").read_text() == "$ echo a\na\n\n$ echo b\nb\n"
+    make_sh(log_txt=(workdir / "log.txt"), quiet=True).run("echo c", prompt="$ ")
+    assert (workdir / "log.txt").read_text().endswith("b\n\n$ echo c\nc\n")
+
+
+@pytest.mark.parametrize("copier", [copy.copy, copy.deepcopy])
+def test_copy_does_not_share_log_fd(
+    make_sh: Callable[..., ShellOperator],
+    workdir: Path,
+    copier: Callable[[ShellOperator], ShellOperator],
+) -> None:
+    """Deleting a copy leaves the log file of the original open."""
+    sh = make_sh(log_txt=(workdir / "log.txt"), quiet=True)
+    sh.run("echo a", prompt="$ ")
+    other = copier(sh)
+    assert other == sh
+    other.run("echo b", prompt="$ ")
+    del other
+    sh.run("echo c", prompt="$ ")
+    sh.close()
+    assert (workdir / "log.txt").read_text() == (
+        "$ echo a\na\n\n$ echo b\nb\n\n$ echo c\nc\n"
+    )
+
+
+def test_remove_previous_outputs(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Previous output files and directories are removed before a run."""
+    (workdir / "d").mkdir()
+    (workdir / "d" / "old.txt").write_text("old\n")
+    (workdir / "f.txt").write_text("old\n")
+    make_sh(quiet=True).run(
+        "mkdir d && echo new > f.txt",
+        output_files_or_dirs=["d", "f.txt", "d"],
+        remove_previous=True,
+        skip_if_exist=False,
+    )
+    assert not any((workdir / "d").iterdir())
+    assert (workdir / "f.txt").read_text() == "new\n"
+
+
+def test_remove_outputs_if_failed(
+    make_sh: Callable[..., ShellOperator], workdir: Path
+) -> None:
+    """Output files and directories of a failed run are removed."""
+    with pytest.raises(subprocess.SubprocessError):
+        make_sh(quiet=True).run(
+            "mkdir d && touch d/a.txt f.txt && false",
+            output_files_or_dirs=[workdir / "d", workdir / "f.txt"],
+        )
+    assert not (workdir / "d").exists()
+    assert not (workdir / "f.txt").exists()
+
+
+@pytest.mark.parametrize(
+    "inputs", [None, "in.txt", Path("in.txt"), ["in.txt", Path("in.txt")]]
+)
+def test_argument_types(
+    make_sh: Callable[..., ShellOperator], workdir: Path, inputs: Any
+) -> None:
+    """None, strings, paths and lists of them are accepted as arguments."""
+    (workdir / "in.txt").write_text("x\n")
+    make_sh(quiet=True).run(
+        ["cat in.txt > a.txt", "cat in.txt > b.txt"],
+        input_files_or_dirs=inputs,
+        output_files_or_dirs=[Path("a.txt"), "b.txt"],
+    )
+    assert (workdir / "b.txt").read_text() == "x\n"
+
+
+def test_missing_input(make_sh: Callable[..., ShellOperator], workdir: Path) -> None:
+    """A missing input is reported before running the command."""
+    sh = make_sh(quiet=True)
+    with pytest.raises(FileNotFoundError, match=r"missing\.txt"):
+        sh.run("touch out.txt", input_files_or_dirs=Path("missing.txt"))
+    assert not (workdir / "out.txt").exists()
+
+
+@pytest.mark.parametrize(
+    ("log_name", "persistent"),
+    [(None, False), ("log.txt", False), (None, True), ("log.txt", True)],
+)
+def test_buffer_stdout_keeps_order(
+    make_sh: Callable[..., ShellOperator],
+    workdir: Path,
+    capfd: pytest.CaptureFixture[str],
+    log_name: Optional[str],
+    persistent: bool,
+) -> None:
+    """Buffered command lines and outputs reach stdout in order."""
+    sh = make_sh(
+        log_txt=(workdir / log_name if log_name else None),
+        buffer_stdout=True,
+        persistent=persistent,
+    )
+    sh.run(["echo a", "echo b"], prompt="$ ")
+    sh.close()
+    assert capfd.readouterr().out == "$ echo a\na\n$ echo b\nb\n"
+
+
+def test_buffer_stdout_prints_deferred_command_lines(
+    make_sh: Callable[..., ShellOperator], capfd: pytest.CaptureFixture[str]
+) -> None:
+    """Command lines whose flush is deferred are all printed."""
+    sh = make_sh(quiet=True, buffer_stdout=True)
+    sh.run("echo a", prompt="$ ")
+    sh.run(["echo b", "echo c"], prompt="$ ", asynchronous=True)
+    sh.wait()
+    sh.close()
+    assert capfd.readouterr().out == "$ echo a\n$ echo b\n$ echo c\n"